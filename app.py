@@ -1,5 +1,5 @@
 from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from socketserver import ThreadingMixIn, TCPServer
 from pathlib import Path
 import os
 
@@ -22,6 +22,8 @@ def _load_env_file() -> None:
 
 _load_env_file()
 import base64
+import bisect
+import datetime
 import html
 import hashlib
 import io
@@ -30,6 +32,7 @@ import mimetypes
 import re
 import shutil
 import subprocess
+import threading
 import time
 import uuid
 import urllib.parse
@@ -109,24 +112,28 @@ def _encode_multipart(fields: dict, boundary: str) -> bytes:
     return b"\r\n".join(lines)
 
 
-def _upload_to_cloudinary(data_url: str, folder: str) -> str:
-    config = _cloudinary_config()
-    if not config:
-        raise RuntimeError("Cloudinary no está configurado.")
+def _cloudinary_upload_params(folder: str, config: dict) -> dict:
+    """Genera los parámetros firmados para una subida a Cloudinary."""
     timestamp = int(time.time())
     public_id = f"photomaton-{uuid.uuid4().hex}"
     signature = _sign_cloudinary(
         {"folder": folder, "public_id": public_id, "timestamp": timestamp},
         config["api_secret"],
     )
-    fields = {
-        "file": data_url,
+    return {
         "api_key": config["api_key"],
         "timestamp": timestamp,
         "folder": folder,
         "public_id": public_id,
         "signature": signature,
     }
+
+
+def _upload_to_cloudinary(data_url: str, folder: str) -> str:
+    config = _cloudinary_config()
+    if not config:
+        raise RuntimeError("Cloudinary no está configurado.")
+    fields = {"file": data_url, **_cloudinary_upload_params(folder, config)}
     boundary = f"photomaton-{uuid.uuid4().hex}"
     body = _encode_multipart(fields, boundary)
     request = urllib.request.Request(
@@ -147,6 +154,114 @@ def _upload_to_cloudinary(data_url: str, folder: str) -> str:
     return secure_url
 
 
+def _published_index_path() -> Path:
+    """Ruta del índice de publicadas, fuera de `public/` para no servirlo."""
+    configured = os.getenv("PUBLISHED_INDEX_PATH", "").strip()
+    if configured:
+        return Path(configured)
+    return Path(__file__).parent / "data" / "publicar-index.jsonl"
+
+
+_PUBLISHED_INDEX: list[dict] | None = None
+_PUBLISHED_INDEX_LOCK = threading.RLock()
+
+
+def _load_published_index() -> list[dict]:
+    """Devuelve el índice de fotos publicadas, ordenado por id y fecha."""
+    global _PUBLISHED_INDEX
+    with _PUBLISHED_INDEX_LOCK:
+        if _PUBLISHED_INDEX is not None:
+            return _PUBLISHED_INDEX
+        entries: list[dict] = []
+        index_path = _published_index_path()
+        if index_path.exists():
+            for line in index_path.read_text(encoding="utf-8").splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if (
+                    isinstance(entry, dict)
+                    and isinstance(entry.get("id"), int)
+                    and isinstance(entry.get("url"), str)
+                    and isinstance(entry.get("createdAt"), (int, float))
+                ):
+                    entries.append(entry)
+        _PUBLISHED_INDEX = entries
+        return entries
+
+
+def _index_published_photos(image_urls: list[str]) -> None:
+    """Añade fotos publicadas al índice sin volver a recorrer las carpetas."""
+    with _PUBLISHED_INDEX_LOCK:
+        entries = _load_published_index()
+        known_urls = {entry["url"] for entry in entries}
+        image_urls = [
+            image_url
+            for image_url in dict.fromkeys(image_urls)
+            if image_url not in known_urls
+        ]
+        if not image_urls:
+            return
+        next_id = entries[-1]["id"] + 1 if entries else 1
+        created_at = max(time.time(), entries[-1]["createdAt"] if entries else 0)
+        new_entries = [
+            {"id": next_id + offset, "url": image_url, "createdAt": created_at}
+            for offset, image_url in enumerate(image_urls)
+        ]
+        index_path = _published_index_path()
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        with index_path.open("a", encoding="utf-8") as index_file:
+            for entry in new_entries:
+                index_file.write(json.dumps(entry) + "\n")
+        entries.extend(new_entries)
+
+
+def _gallery_page(entries: list[dict], cursor: int, limit: int) -> dict:
+    start = bisect.bisect_right(entries, cursor, key=lambda entry: entry["id"])
+    items = entries[start : start + limit]
+    return {
+        "items": items,
+        "nextCursor": items[-1]["id"] if items else cursor,
+        "hasMore": start + limit < len(entries),
+    }
+
+
+def _published_in_range(entries: list[dict], start: float, end: float) -> list[dict]:
+    first = bisect.bisect_left(entries, start, key=lambda entry: entry["createdAt"])
+    last = bisect.bisect_right(entries, end, key=lambda entry: entry["createdAt"])
+    return entries[first:last]
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Compara If-None-Match con un ETag: admite listas, `*` y prefijos `W/`."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _parse_time_param(value: str, default: float) -> float:
+    """Acepta segundos epoch o fechas ISO 8601 (hora local si no hay zona)."""
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError as error:
+        raise ValueError("Fecha inválida.") from error
+
+
 def _store_photos(images: list[str], root: Path, publish: bool) -> list[str]:
     config = _cloudinary_config()
     saved_paths: list[str] = []
@@ -154,19 +269,100 @@ def _store_photos(images: list[str], root: Path, publish: bool) -> list[str]:
         target_folder = "publicar" if publish else "uploads"
         for image_data_url in images:
             saved_paths.append(_save_data_url(image_data_url, root, folder=target_folder))
+        if publish:
+            _index_published_photos(saved_paths)
         return saved_paths
 
     base_folder = config["folder"]
     all_folder = f"{base_folder}/todas"
     publish_folder = f"{base_folder}/publicar"
+    published_urls: list[str] = []
     for image_data_url in images:
         _validate_data_url(image_data_url)
         saved_paths.append(_upload_to_cloudinary(image_data_url, all_folder))
         if publish:
-            _upload_to_cloudinary(image_data_url, publish_folder)
+            published_urls.append(_upload_to_cloudinary(image_data_url, publish_folder))
+    _index_published_photos(published_urls)
     return saved_paths
 
 
+MAX_DIRECT_UPLOADS = 10
+UPLOAD_SIGNATURE_TTL = 3600
+# Subidas firmadas pendientes de registrar: "<folder>/<public_id>" -> caducidad
+_ISSUED_UPLOADS: dict[str, float] = {}
+_ISSUED_UPLOADS_LOCK = threading.Lock()
+
+
+def _issue_upload_signatures(count: int, publish: bool) -> dict:
+    """Firma subidas directas desde el navegador a Cloudinary.
+
+    Cloudinary rechaza firmas con un timestamp de más de una hora, así que los
+    parámetros caducan solos si el photomaton no llega a usarlos.
+    """
+    config = _cloudinary_config()
+    if not config:
+        raise RuntimeError("Cloudinary no está configurado.")
+    if count < 1 or count > MAX_DIRECT_UPLOADS:
+        raise ValueError("Número de fotos inválido.")
+    base_folder = config["folder"]
+    uploads = []
+    for _ in range(count):
+        item = {"todas": _cloudinary_upload_params(f"{base_folder}/todas", config)}
+        if publish:
+            item["publicar"] = _cloudinary_upload_params(
+                f"{base_folder}/publicar", config
+            )
+        with _ISSUED_UPLOADS_LOCK:
+            for params in item.values():
+                issued_key = f"{params['folder']}/{params['public_id']}"
+                _ISSUED_UPLOADS[issued_key] = params["timestamp"] + UPLOAD_SIGNATURE_TTL
+        uploads.append(item)
+    return {
+        "uploadUrl": (
+            f"https://api.cloudinary.com/v1_1/{config['cloud_name']}/image/upload"
+        ),
+        "uploads": uploads,
+    }
+
+
+def _direct_upload_keys(image_urls: list[str], subfolder: str = "todas") -> list[str]:
+    """Extrae "<folder>/<public_id>" de URLs de subidas propias en `subfolder`."""
+    config = _cloudinary_config()
+    if not config:
+        raise RuntimeError("Cloudinary no está configurado.")
+    if len(image_urls) > MAX_DIRECT_UPLOADS:
+        raise ValueError("Número de fotos inválido.")
+    folder = f"{config['folder']}/{subfolder}"
+    pattern = re.compile(
+        rf"^https://res\.cloudinary\.com/{re.escape(config['cloud_name'])}"
+        rf"/image/upload/(?:v\d+/)?{re.escape(folder)}"
+        r"/(photomaton-[0-9a-f]{32})\.[a-zA-Z0-9]+$"
+    )
+    keys = []
+    for image_url in image_urls:
+        match = pattern.match(image_url) if isinstance(image_url, str) else None
+        if not match:
+            raise ValueError("URL de imagen inválida.")
+        keys.append(f"{folder}/{match.group(1)}")
+    return keys
+
+
+def _claim_direct_uploads(image_urls: list[str], published_urls: list[str]) -> None:
+    """Acepta solo subidas firmadas por este servidor y consume cada una una vez."""
+    keys = _direct_upload_keys(image_urls) + _direct_upload_keys(
+        published_urls, subfolder="publicar"
+    )
+    now = time.time()
+    with _ISSUED_UPLOADS_LOCK:
+        for issued_key, expires_at in list(_ISSUED_UPLOADS.items()):
+            if expires_at < now:
+                del _ISSUED_UPLOADS[issued_key]
+        if len(set(keys)) != len(keys) or any(key not in _ISSUED_UPLOADS for key in keys):
+            raise ValueError("Subida no autorizada o ya registrada.")
+        for key in keys:
+            del _ISSUED_UPLOADS[key]
+
+
 def _get_tunnel_url() -> str | None:
     configured = os.getenv("PUBLIC_TUNNEL_URL", "").strip()
     if configured:
@@ -363,6 +559,10 @@ def _fetch_qr_image(data: str, size: str = "240x240") -> tuple[bytes, str]:
     raise last_error or RuntimeError("No se pudo generar el QR.")
 
 
+GALLERY_PAGE_SIZE = 24
+GALLERY_MAX_PAGE_SIZE = 100
+
+
 class PhotomatonHandler(SimpleHTTPRequestHandler):
     def do_GET(self) -> None:
         parsed_url = urllib.parse.urlparse(self.path)
@@ -386,6 +586,77 @@ class PhotomatonHandler(SimpleHTTPRequestHandler):
             self.wfile.write(payload)
             return
 
+        # Galería de fotos publicadas: /api/gallery?cursor=ID&limit=N
+        if parsed_url.path == "/api/gallery":
+            query = urllib.parse.parse_qs(parsed_url.query)
+            try:
+                cursor = int(query.get("cursor", ["0"])[0])
+                limit = int(query.get("limit", [str(GALLERY_PAGE_SIZE)])[0])
+            except ValueError:
+                _send_json(self, {"error": "Parámetros inválidos."}, status=400)
+                return
+            limit = max(1, min(limit, GALLERY_MAX_PAGE_SIZE))
+            entries = _load_published_index()
+            last_id = entries[-1]["id"] if entries else 0
+            etag = f'"{last_id}-{cursor}-{limit}"'
+            if _etag_matches(self.headers.get("If-None-Match"), etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            page = _gallery_page(entries, cursor, limit)
+            response = json.dumps(page).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(response)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(response)
+            return
+
+        # Exportación de publicadas: /api/gallery/export?from=FECHA&to=FECHA
+        if parsed_url.path == "/api/gallery/export":
+            query = urllib.parse.parse_qs(parsed_url.query)
+            try:
+                start = _parse_time_param(query.get("from", [""])[0], 0.0)
+                end = _parse_time_param(query.get("to", [""])[0], time.time())
+            except ValueError as error:
+                _send_json(self, {"error": str(error)}, status=400)
+                return
+            entries = _published_in_range(
+                _load_published_index(), start, end
+            )
+            # Sin Content-Length: el ZIP se escribe en streaming y se cierra la conexión
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header(
+                "Content-Disposition", 'attachment; filename="photomaton-publicadas.zip"'
+            )
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            with zipfile.ZipFile(self.wfile, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+                for entry in entries:
+                    image_path = entry["url"]
+                    filename = Path(
+                        urllib.parse.urlparse(image_path).path
+                    ).name or f"photo-{entry['id']}.png"
+                    if image_path.startswith("http"):
+                        try:
+                            with urllib.request.urlopen(image_path, timeout=10) as response:
+                                payload = response.read()
+                        except Exception:
+                            continue
+                        # Los errores al escribir en el cliente cortan la exportación
+                        zip_file.writestr(filename, payload)
+                    else:
+                        file_path = Path(self.directory) / image_path.lstrip("/")
+                        if not file_path.exists():
+                            continue
+                        zip_file.write(file_path, arcname=filename)
+            return
+
         if self.path in {"", "/"}:
             self.path = "/index.html"
             super().do_GET()
@@ -619,7 +890,11 @@ class PhotomatonHandler(SimpleHTTPRequestHandler):
         super().do_GET()
 
     def do_POST(self) -> None:
-        if self.path != "/api/create-session":
+        if self.path not in {
+            "/api/create-session",
+            "/api/upload-signature",
+            "/api/register-uploads",
+        }:
             self.send_error(404)
             return
 
@@ -634,6 +909,17 @@ class PhotomatonHandler(SimpleHTTPRequestHandler):
         except json.JSONDecodeError:
             _send_json(self, {"error": "JSON inválido."}, status=400)
             return
+        if not isinstance(payload, dict):
+            _send_json(self, {"error": "JSON inválido."}, status=400)
+            return
+
+        if self.path == "/api/upload-signature":
+            self._handle_upload_signature(payload)
+            return
+
+        if self.path == "/api/register-uploads":
+            self._handle_register_uploads(payload)
+            return
 
         images = payload.get("images")
         if not isinstance(images, list) or not images:
@@ -676,9 +962,55 @@ class PhotomatonHandler(SimpleHTTPRequestHandler):
         download_url = f"{base_url}/download?t={token}"
         _send_json(self, {"downloadUrl": download_url})
 
+    def _handle_upload_signature(self, payload: dict) -> None:
+        count = payload.get("count")
+        if not isinstance(count, int) or isinstance(count, bool):
+            _send_json(self, {"error": "Número de fotos inválido."}, status=400)
+            return
+        publish = payload.get("publish", False)
+        if not isinstance(publish, bool):
+            publish = False
+        if not _cloudinary_config():
+            # Sin Cloudinary el cliente vuelve a /api/create-session
+            _send_json(self, {"error": "Cloudinary no está configurado."}, status=404)
+            return
+        try:
+            signatures = _issue_upload_signatures(count, publish)
+        except ValueError as error:
+            _send_json(self, {"error": str(error)}, status=400)
+            return
+        _send_json(self, signatures)
+
+    def _handle_register_uploads(self, payload: dict) -> None:
+        images = payload.get("images")
+        if not isinstance(images, list) or not images:
+            _send_json(self, {"error": "Faltan las imágenes."}, status=400)
+            return
+        if not _cloudinary_config():
+            _send_json(self, {"error": "Cloudinary no está configurado."}, status=404)
+            return
+        published = payload.get("published", [])
+        if not isinstance(published, list):
+            _send_json(self, {"error": "URL de imagen inválida."}, status=400)
+            return
+        try:
+            _claim_direct_uploads(images, published)
+        except ValueError as error:
+            _send_json(self, {"error": str(error)}, status=400)
+            return
+
+        base_url = _resolve_base_url_for_request(self)
+        _index_published_photos(published)
+        _save_session(images, Path(self.directory))
+        token = _encode_images_token(images)
+        download_url = f"{base_url}/download?t={token}"
+        _send_json(self, {"downloadUrl": download_url})
+
 
-class ReusableTCPServer(TCPServer):
+class ReusableTCPServer(ThreadingMixIn, TCPServer):
+    # Un hilo por petición: la exportación no bloquea al photomaton ni a la galería
     allow_reuse_address = True
+    daemon_threads = True
 
 
 def main() -> None:
@@ -544,23 +544,82 @@ const startCamera = async () => {
   }
 };
 
+const uploadSignedPhoto = async (uploadUrl, params, blob) => {
+  const formData = new FormData();
+  formData.append("file", blob);
+  Object.entries(params).forEach(([key, value]) => formData.append(key, value));
+  const response = await fetch(uploadUrl, { method: "POST", body: formData });
+  const payload = await response.json();
+  if (!response.ok || !payload.secure_url) {
+    throw new Error(payload.error?.message || "No se pudo subir la foto.");
+  }
+  return payload.secure_url;
+};
+
+// Sube las fotos directamente a Cloudinary con firmas emitidas por el servidor.
+// Devuelve null si el servidor no tiene Cloudinary configurado.
+const createDirectUploadSession = async (publish) => {
+  const signatureResponse = await fetch("/api/upload-signature", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ count: photoDataUrls.length, publish }),
+  });
+  if (!signatureResponse.ok) {
+    return null;
+  }
+  const { uploadUrl, uploads } = await signatureResponse.json();
+  const uploaded = await Promise.all(
+    photoDataUrls.map(async (dataUrl, index) => {
+      const blob = await (await fetch(dataUrl)).blob();
+      const signed = uploads[index];
+      return Promise.all([
+        uploadSignedPhoto(uploadUrl, signed.todas, blob),
+        signed.publicar ? uploadSignedPhoto(uploadUrl, signed.publicar, blob) : null,
+      ]);
+    })
+  );
+  const imageUrls = uploaded.map(([secureUrl]) => secureUrl);
+  const publishedUrls = uploaded.map(([, publishedUrl]) => publishedUrl).filter(Boolean);
+  const response = await fetch("/api/register-uploads", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ images: imageUrls, published: publishedUrls }),
+  });
+  const payload = await response.json();
+  if (!response.ok) {
+    throw new Error(payload.error || "No se pudo generar el enlace.");
+  }
+  return payload.downloadUrl;
+};
+
+const createProxiedSession = async (publish) => {
+  const response = await fetch("/api/create-session", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ images: photoDataUrls, publish }),
+  });
+  const payload = await response.json();
+  if (!response.ok) {
+    throw new Error(payload.error || "No se pudo generar el enlace.");
+  }
+  return payload.downloadUrl;
+};
+
 const createDownloadSession = async () => {
   if (!photoDataUrls.length) {
     downloadStatus.textContent = "No hay fotos disponibles para descargar.";
     return;
   }
   downloadStatus.textContent = "Generando enlace seguro...";
+  const publish = publishChoice === true;
   try {
-    const response = await fetch("/api/create-session", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ images: photoDataUrls, publish: publishChoice === true }),
-    });
-    const payload = await response.json();
-    if (!response.ok) {
-      throw new Error(payload.error || "No se pudo generar el enlace.");
+    let sessionUrl = null;
+    try {
+      sessionUrl = await createDirectUploadSession(publish);
+    } catch (error) {
+      sessionUrl = null;
     }
-    downloadUrl = payload.downloadUrl;
+    downloadUrl = sessionUrl || (await createProxiedSession(publish));
     downloadStatus.textContent = "Enlace listo.";
     statusLabel.textContent = "QR de descarga preparado.";
     if (qrPanel && qrImage) {